@@ -1,6 +1,9 @@
 import importlib.metadata
 
-from kiwis_pie.kiwis import KIWIS, KIWISError, NoDataError
+from kiwis_pie.kiwis import KIWIS, KIWISError, NoDataError, TransferStats
+from kiwis_pie.archive import ResponseArchive
+from kiwis_pie.federated import FederatedKIWIS
+from kiwis_pie.snapshot import CatalogSnapshot, save_catalog_snapshot
 
 try:
     __version__ = importlib.metadata.version(__name__)
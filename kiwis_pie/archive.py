@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+import zlib
+
+from urllib.parse import urlencode
+from urllib.request import pathname2url
+
+import logging
+logger = logging.getLogger(__name__)
+
+class ResponseArchive(object):
+    """
+        On-disk store of raw KiWIS responses for recording and replaying
+        queries without access to the KiWIS server.
+
+        Responses are stored zlib compressed in a single SQLite file, indexed
+        by the server URL and the sorted query parameters.
+
+        :param path: Path to the archive file. Created if it doesn't exist.
+        :type path: string
+        :param mode: Either 'record', to query the server and store every
+            response, or 'replay', to serve responses from the archive only.
+            The archive must already exist in replay mode. Default: 'replay'
+        :type mode: string
+    """
+
+    modes = ('record', 'replay')
+
+    def __init__(self, path, mode='replay'):
+        if mode not in self.modes:
+            raise ValueError(mode)
+
+        self.path = path
+        self.mode = mode
+        self.__lock = threading.Lock()
+        if mode == 'replay':
+            # Read-only so a wrong path fails here instead of creating an empty archive.
+            self.__db = sqlite3.connect(
+                'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(path))),
+                uri = True,
+                check_same_thread = False,
+            )
+        else:
+            self.__db = sqlite3.connect(path, check_same_thread = False)
+            with self.__lock, self.__db:
+                self.__db.execute(
+                    'CREATE TABLE IF NOT EXISTS responses (query TEXT PRIMARY KEY, url TEXT, body BLOB)'
+                )
+
+    @staticmethod
+    def query_key(server_url, params):
+        """
+            Normalise a query into the key used to index the archive.
+        """
+        return '{0}?{1}'.format(
+            server_url,
+            urlencode(sorted((str(k), str(v)) for k, v in params.items()))
+        )
+
+    def get(self, server_url, params):
+        """
+            Return the (compressed size, raw response body) stored for a query.
+
+            :raises KeyError: if the query has not been recorded.
+        """
+        key = self.query_key(server_url, params)
+        with self.__lock:
+            row = self.__db.execute('SELECT body FROM responses WHERE query = ?', (key,)).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+
+        logger.debug('Replaying %s', key)
+        return len(row[0]), zlib.decompress(row[0])
+
+    def put(self, server_url, params, url, content):
+        """
+            Store the raw response body for a query, replacing any previous one.
+        """
+        key = self.query_key(server_url, params)
+        logger.debug('Recording %s', key)
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO responses (query, url, body) VALUES (?, ?, ?)',
+                (key, url, zlib.compress(content))
+            )
+
+    def __len__(self):
+        with self.__lock:
+            return self.__db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from kiwis_pie.kiwis import KIWIS, NoDataError, basestring
+from kiwis_pie.snapshot import save_catalog_snapshot
+
+import logging
+logger = logging.getLogger(__name__)
+
+class FederatedKIWIS(object):
+    """
+        Provides concurrent access to several KiWIS end points at once.
+
+        Queries are sent to every end point in parallel so the total latency
+        is that of the slowest end point rather than the sum of all of them.
+
+        :param sources: Mapping of source name to either a KIWIS instance or
+            the URL of a KiWIS server.
+        :type sources: dict[str, KIWIS | str]
+        :param max_workers: (optional) Maximum number of sources queried
+            concurrently by the list methods. Defaults to one per source.
+        :type max_workers: int
+        :param max_workers_per_source: (optional) Maximum number of concurrent
+            value requests sent to each source. Every source has its own
+            workers so requests to one source never wait behind another's.
+            Default: 4
+        :type max_workers_per_source: int
+        :param source_column: (optional) Name of the column used to label
+            each row with the source it came from. Default: 'source'
+        :type source_column: string
+        :param kwargs: Passed through to KIWIS for sources given as URLs.
+    """
+
+    def __init__(self, sources, max_workers=None, max_workers_per_source=4, source_column='source', **kwargs):
+        self.sources = {}
+        for name, source in sources.items():
+            if isinstance(source, basestring):
+                source = KIWIS(source, **kwargs)
+            self.sources[name] = source
+
+        self.max_workers = max_workers if max_workers is not None else max(len(self.sources), 1)
+        self.max_workers_per_source = max_workers_per_source
+        self.source_column = source_column
+
+    def _run(self, calls):
+        """
+            Run each (key, function) pair in calls concurrently.
+
+            Returns a list of (key, result, exception) in the order of calls.
+        """
+        calls = list(calls)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(key, executor.submit(func)) for key, func in calls]
+            results = []
+            for key, future in futures:
+                try:
+                    results.append((key, future.result(), None))
+                except Exception as e:
+                    results.append((key, None, e))
+        return results
+
+    def get_timeseries_values(self, ts_ids, **kwargs):
+        """
+            Query timeseries values from the sources that own them.
+
+            Each ts_id is only sent to the KiWIS server of its source. Sources
+            are queried concurrently, each with up to max_workers_per_source
+            requests in flight.
+
+            :param ts_ids: The timeseries to fetch as (source, ts_id) pairs.
+            :type ts_ids: list((string, string))
+            :param kwargs: Passed through to KIWIS.get_timeseries_values.
+            :return: Dictionary mapping each (source, ts_id) pair to its
+                Pandas DataFrame of values. Pairs with no data are left out;
+                NoDataError is only raised when none of them return data.
+            :rtype: dict
+        """
+        ts_ids = [tuple(pair) for pair in ts_ids]
+        for source, ts_id in ts_ids:
+            if source not in self.sources:
+                raise ValueError(source)
+
+        # Each source gets its own executor, so a long queue of requests to
+        # one source doesn't hold up the requests to the others.
+        executors = {}
+        futures = []
+        try:
+            for source, ts_id in ts_ids:
+                if source not in executors:
+                    executors[source] = ThreadPoolExecutor(max_workers=self.max_workers_per_source)
+                futures.append((
+                    (source, ts_id),
+                    executors[source].submit(self.sources[source].get_timeseries_values, ts_id=ts_id, **kwargs),
+                ))
+
+            results = {}
+            for key, future in futures:
+                try:
+                    results[key] = future.result()
+                except NoDataError:
+                    logger.debug('No data for %s', key)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(cancel_futures=True)
+
+        if len(futures) > 0 and len(results) == 0:
+            raise NoDataError()
+
+        return results
+
+def __gen_federated_method(cls, snake_name):
+
+    def federated_method(self, snapshot = None, **kwargs):
+        def fetch(source):
+            return lambda: getattr(self.sources[source], snake_name)(**kwargs)
+
+        frames = []
+        for source, df, error in self._run((source, fetch(source)) for source in self.sources):
+            if isinstance(error, NoDataError):
+                logger.debug('No data from source %s', source)
+                continue
+            elif error is not None:
+                raise error
+
+            if self.source_column in df.columns:
+                raise ValueError(
+                    "Source '{0}' returned a '{1}' column, which clashes with source_column; "
+                    "choose a different source_column.".format(source, self.source_column)
+                )
+            frames.append((source, df))
+
+        if len(frames) == 0:
+            raise NoDataError()
+
+        for source, df in frames:
+            df.insert(0, self.source_column, source)
+
+        df = pd.concat([df for source, df in frames], ignore_index = True)
+        if snapshot is not None:
+            save_catalog_snapshot(df, snapshot)
+        return df
+
+    federated_method.__doc__ = "Query '{0}' on all sources concurrently.\n\n".format(snake_name)
+    federated_method.__doc__ += "Results are merged into a single DataFrame with an extra column naming the source of each row. "
+    federated_method.__doc__ += "Sources with no matches are skipped; NoDataError is only raised when no source returns data. "
+    federated_method.__doc__ += "A snapshot, if requested, is saved once from the merged DataFrame.\n\n"
+    federated_method.__doc__ += getattr(KIWIS, snake_name).__doc__
+
+    setattr(cls, snake_name, federated_method)
+
+for __snake_name in [
+        'get_parameter_list',
+        'get_parameter_type_list',
+        'get_site_list',
+        'get_station_list',
+        'get_timeseries_list',
+    ]:
+    __gen_federated_method(FederatedKIWIS, __snake_name)
@@ -1,17 +1,25 @@
 import collections
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 try:
     from collections.abc import Iterable
 except ImportError:
     from collections import Iterable
 
 QueryOption = collections.namedtuple('QueryOption', ['wildcard', 'list', 'parser'])
+TransferStats = collections.namedtuple('TransferStats', ['url', 'content_encoding', 'compressed_bytes', 'decompressed_bytes'])
 
+import json
+import multiprocessing
+import numpy as np
 import pandas as pd
+from pandas.tseries.frequencies import to_offset
 import pytz
 import re
 import requests
 from tabulate import tabulate
 
+from kiwis_pie.snapshot import save_catalog_snapshot
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -51,12 +59,26 @@ class KIWIS(object):
         :type verify_ssl: boolean | str
         :param headers: HTTP headers to pass along with the `GET` request to the KiWIS server.
         :type headers: dict[str, Any]
+        :param stream_chunk_size: (optional) Number of bytes read from the
+            response at a time. Default: 65536
+        :type stream_chunk_size: int
+        :param archive: (optional) Record responses to, or replay them from,
+            the given archive instead of always querying the server.
+        :type archive: kiwis_pie.archive.ResponseArchive
+        :param on_transfer: (optional) Called with a TransferStats tuple of
+            (url, content_encoding, compressed_bytes, decompressed_bytes) for
+            every response, including those fetched concurrently.
+        :type on_transfer: callable
+
+        The TransferStats of the most recent response is also available as
+        ``last_transfer``. When requests run concurrently this is only the
+        last one to finish; use on_transfer to see all of them.
     """
 
     __method_args = {}
     __return_args = {}
 
-    def __init__(self, server_url, strict_mode=True, verify_ssl=True, headers=None):
+    def __init__(self, server_url, strict_mode=True, verify_ssl=True, headers=None, stream_chunk_size=65536, archive=None, on_transfer=None):
         self.server_url = server_url
         self.__default_args = {
             'service': 'kisters',
@@ -67,68 +89,302 @@ class KIWIS(object):
         self.strict_mode = strict_mode
         self.verify_ssl = verify_ssl
         self.headers = headers
+        self.stream_chunk_size = stream_chunk_size
+        self.archive = archive
+        self.on_transfer = on_transfer
+        self.last_transfer = None
 
-def __parse_date(input_dt):
-    return pd.to_datetime(input_dt).strftime('%Y-%m-%d')
-
-def __gen_kiwis_method(cls, method_name, available_query_options, available_return_fields):
-
-    start_snake = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', method_name)
-    snake_name = re.sub('([a-z0-9])([A-Z])', r'\1_\2', start_snake).lower()
-
-    cls._KIWIS__method_args[method_name] = available_query_options
-    cls._KIWIS__return_args[method_name] = available_return_fields
-    def kiwis_method(self, return_fields = None, keep_tz=False, verify = True, **kwargs):
-
+    def __build_params(self, method_name, return_fields, kwargs):
         if self.strict_mode:
             for query_key in kwargs.keys():
-                if query_key not in self._KIWIS__method_args[method_name].keys():
+                if query_key not in self.__method_args[method_name].keys():
                     raise ValueError(query_key)
 
-                if (self._KIWIS__method_args[method_name][query_key].list and
+                if (self.__method_args[method_name][query_key].list and
                         isinstance(kwargs[query_key], Iterable) and
                         not isinstance(kwargs[query_key], basestring)):
                     kwargs[query_key] = ','.join(kwargs[query_key])
 
-                if self._KIWIS__method_args[method_name][query_key].parser is not None:
-                    kwargs[query_key] = self._KIWIS__method_args[method_name][query_key].parser(kwargs[query_key])
+                if self.__method_args[method_name][query_key].parser is not None:
+                    kwargs[query_key] = self.__method_args[method_name][query_key].parser(kwargs[query_key])
 
             if return_fields is not None:
                 for return_key in return_fields:
-                    if return_key not in self._KIWIS__return_args[method_name]:
+                    if return_key not in self.__return_args[method_name]:
                         raise ValueError(return_key)
 
-        params = self._KIWIS__default_args.copy()
+        params = self.__default_args.copy()
         params.update(kwargs)
         params['request'] = method_name
         if return_fields is not None:
             params['returnfields'] = ','.join(return_fields)
 
-        r = requests.get(self.server_url, params = params, verify = self.verify_ssl, headers=self.headers)
-        logger.debug(r.url)
-        logger.debug(r.status_code)
-        r.raise_for_status() #raise error if service returns an error, i.e. 404, 500 etc.
-
-        json_data = r.json()
-        if type(json_data) is dict and 'type' in json_data.keys() and json_data['type'] == 'error':
-            raise KIWISError(
-                'KIWIS returned an error:\n\tCode: {0}\n\tMessage: "{1}"'.format(
-                    json_data['code'],
-                    json_data['message']
-                )
+        return params
+
+    def __record_transfer(self, stats):
+        logger.debug(stats)
+        self.last_transfer = stats
+        if self.on_transfer is not None:
+            self.on_transfer(stats)
+
+    def __get_json(self, params):
+        return _parse_json(self.__fetch(params))
+
+    def __fetch(self, params):
+        if self.archive is not None and self.archive.mode == 'replay':
+            compressed_bytes, content = self.archive.get(self.server_url, params)
+            stats = TransferStats(
+                self.archive.query_key(self.server_url, params),
+                'archive',
+                compressed_bytes,
+                len(content),
+            )
+            self.__record_transfer(stats)
+            return content
+
+        with requests.get(self.server_url, params = params, verify = self.verify_ssl, headers=self.headers, stream = True) as r:
+            logger.debug(r.url)
+            logger.debug(r.status_code)
+            r.raise_for_status() #raise error if service returns an error, i.e. 404, 500 etc.
+
+            # Read the body the same way r.content does, but streamed so the
+            # compressed size can be taken from r.raw afterwards. Peak memory
+            # is unchanged: the decoded body is held in full and json.loads
+            # makes its own str copy of it.
+            content = b''.join(r.iter_content(self.stream_chunk_size))
+
+            stats = TransferStats(
+                r.url,
+                r.headers.get('Content-Encoding', 'identity'),
+                r.raw.tell(),
+                len(content),
+            )
+
+        # Fetches may run concurrently, so only use the local stats here.
+        if self.archive is not None:
+            self.archive.put(self.server_url, params, stats.url, content)
+
+        self.__record_transfer(stats)
+        return content
+
+    def get_timeseries_matrix(self, ts_ids, freq=None, quality_codes=None, chunk_size=100,
+            max_workers=1, decode_processes=None, **kwargs):
+        """
+            Fetch several timeseries and align them into a single wide DataFrame.
+
+            The values are requested in batches of ts_ids and written into a
+            preallocated array indexed by the union of all timestamps (or a
+            regular grid when freq is given), avoiding repeated concat/join.
+
+            :param ts_ids: The timeseries IDs to fetch.
+            :type ts_ids: list(string)
+            :param freq: (optional) Fixed frequency to resample to, e.g. '15min',
+                'h' or 'D'. Each value is the mean of the observations in
+                the interval, with intervals aligned to multiples of freq
+                since the epoch (UTC). Default: no resampling.
+            :type freq: string
+            :param quality_codes: (optional) Quality codes to keep. Values with
+                any other quality code are masked out (NaN). Default: keep all.
+            :type quality_codes: list
+            :param chunk_size: (optional) Number of ts_ids per request. Default: 100
+            :type chunk_size: int
+            :param max_workers: (optional) Number of requests made concurrently. Default: 1
+            :type max_workers: int
+            :param decode_processes: (optional) Decode responses in a process
+                pool instead of the calling process, so that JSON decoding of
+                large responses is not limited by the GIL. Either the number
+                of processes to start (using the forkserver start method, or
+                spawn where that isn't available) or an existing
+                concurrent.futures.Executor to reuse. Default: decode inline.
+            :type decode_processes: int | concurrent.futures.Executor
+            :param kwargs: Queryfields passed through to getTimeseriesValues,
+                e.g. 'from', 'to' or 'period'.
+            :return: Pandas DataFrame with a UTC DatetimeIndex and one column
+                per ts_id.
+            :rtype: pandas.DataFrame
+        """
+        ts_ids = [str(ts_id) for ts_id in ts_ids]
+        step = None if freq is None else to_offset(freq).nanos # ValueError for non-fixed frequencies
+
+        return_fields = ['Timestamp', 'Value']
+        if quality_codes is not None:
+            return_fields.append('Quality Code')
+
+        requests_params = [
+            self.__build_params(
+                'getTimeseriesValues',
+                return_fields,
+                dict(kwargs, ts_id = ','.join(ts_ids[i:i + chunk_size])),
+            )
+            for i in range(0, len(ts_ids), chunk_size)
+        ]
+
+        if decode_processes is None:
+            decoder = None
+        elif isinstance(decode_processes, Executor):
+            decoder = decode_processes
+        else:
+            # Workers are started while fetch threads are running, so avoid
+            # fork, which can deadlock on locks held by those threads.
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            decoder = ProcessPoolExecutor(
+                max_workers = decode_processes,
+                mp_context = multiprocessing.get_context(start_method),
             )
 
-        if json_data is None or json_data[0] == "No matches.":
+        series = {}
+        try:
+            with ThreadPoolExecutor(max_workers = max_workers) as fetcher:
+                fetches = [fetcher.submit(self.__fetch, params) for params in requests_params]
+                decodes = []
+                for fetch in as_completed(fetches):
+                    if decoder is None:
+                        decodes.append(fetcher.submit(_decode_timeseries_response, fetch.result(), quality_codes))
+                    else:
+                        # Only the raw bytes and the decoded numpy arrays cross
+                        # the process boundary, both of which pickle as buffers.
+                        decodes.append(decoder.submit(_decode_timeseries_response, fetch.result(), quality_codes))
+
+                for decode in decodes:
+                    try:
+                        decoded = decode.result()
+                    except NoDataError:
+                        continue
+                    for ts_id, times, values in decoded:
+                        series[ts_id] = (times, values)
+        finally:
+            if decoder is not None and decoder is not decode_processes:
+                decoder.shutdown()
+
+        if len(series) == 0 or all(len(times) == 0 for times, values in series.values()):
             raise NoDataError()
 
-        if method_name in [
-                'getParameterList',
-                'getParameterTypeList',
-                'getSiteList',
-                'getStationList',
-                'getTimeseriesList'
-            ]:
-            return pd.DataFrame(json_data[1:], columns = json_data[0])
+        return _align_timeseries(ts_ids, series, step)
+
+_LIST_METHODS = [
+    'getParameterList',
+    'getParameterTypeList',
+    'getSiteList',
+    'getStationList',
+    'getTimeseriesList',
+]
+
+def _parse_json(content):
+    """
+        Parse a raw KiWIS response body, raising KIWISError or NoDataError
+        when the service reports an error or no matches.
+    """
+    json_data = json.loads(content)
+    if type(json_data) is dict and 'type' in json_data.keys() and json_data['type'] == 'error':
+        raise KIWISError(
+            'KIWIS returned an error:\n\tCode: {0}\n\tMessage: "{1}"'.format(
+                json_data['code'],
+                json_data['message']
+            )
+        )
+
+    if json_data is None or json_data[0] == "No matches.":
+        raise NoDataError()
+
+    return json_data
+
+def _decode_timeseries_values(json_data, quality_codes=None):
+    """
+        Decode a getTimeseriesValues response into (ts_id, times, values)
+        tuples of numpy arrays, with times as int64 nanoseconds since the
+        epoch (UTC). Values not matching quality_codes are dropped.
+    """
+    decoded = []
+    for entry in json_data:
+        columns = entry['columns'].split(',')
+        data = entry['data']
+
+        if len(data) == 0:
+            decoded.append((str(entry['ts_id']), np.empty(0, dtype='i8'), np.empty(0)))
+            continue
+
+        fields = list(zip(*data))
+        times = pd.to_datetime(list(fields[columns.index('Timestamp')]), utc = True)
+        times = times.tz_localize(None).values.astype('datetime64[ns]').view('i8')
+        values = np.array(fields[columns.index('Value')], dtype = float)
+
+        keep = ~np.isnan(values)
+        if quality_codes is not None:
+            quality = np.array(fields[columns.index('Quality Code')]).astype(str)
+            keep &= np.isin(quality, [str(code) for code in quality_codes])
+
+        decoded.append((str(entry['ts_id']), times[keep], values[keep]))
+
+    return decoded
+
+def _decode_timeseries_response(content, quality_codes=None):
+    """
+        Parse and decode a raw getTimeseriesValues response body.
+
+        Defined at module level so it can be run in a process pool.
+    """
+    return _decode_timeseries_values(_parse_json(content), quality_codes)
+
+def _align_timeseries(ts_ids, series, step=None):
+    """
+        Build a wide DataFrame from a mapping of ts_id to (times, values).
+
+        The index is computed up front, either as the union of all timestamps
+        or, when step (in nanoseconds) is given, a regular grid of intervals
+        whose values are the mean of the observations falling within them.
+    """
+    all_times = [times for times, values in series.values()]
+    if step is None:
+        index = np.unique(np.concatenate(all_times))
+    else:
+        start = min(times.min() for times in all_times if len(times)) // step
+        end = max(times.max() for times in all_times if len(times)) // step
+        index = np.arange(start, end + 1, dtype = 'i8') * step
+
+    matrix = np.full((len(index), len(ts_ids)), np.nan, order = 'F')
+    for j, ts_id in enumerate(ts_ids):
+        if ts_id not in series:
+            continue
+        times, values = series[ts_id]
+        if step is None:
+            matrix[np.searchsorted(index, times), j] = values
+        else:
+            bins = times // step - start
+            counts = np.bincount(bins, minlength = len(index))
+            sums = np.bincount(bins, weights = values, minlength = len(index))
+            with np.errstate(invalid = 'ignore'):
+                matrix[:, j] = sums / counts
+
+    return pd.DataFrame(
+        matrix,
+        index = pd.to_datetime(index, unit = 'ns', utc = True).rename('Timestamp'),
+        columns = ts_ids,
+        copy = False,
+    )
+
+def __parse_date(input_dt):
+    return pd.to_datetime(input_dt).strftime('%Y-%m-%d')
+
+def __gen_kiwis_method(cls, method_name, available_query_options, available_return_fields):
+
+    start_snake = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', method_name)
+    snake_name = re.sub('([a-z0-9])([A-Z])', r'\1_\2', start_snake).lower()
+
+    cls._KIWIS__method_args[method_name] = available_query_options
+    cls._KIWIS__return_args[method_name] = available_return_fields
+    def kiwis_method(self, return_fields = None, keep_tz=False, verify = True, snapshot = None, **kwargs):
+
+        if snapshot is not None and method_name not in _LIST_METHODS:
+            raise ValueError('snapshot is only supported by list methods, not {0}'.format(method_name))
+
+        params = self._KIWIS__build_params(method_name, return_fields, kwargs)
+        json_data = self._KIWIS__get_json(params)
+
+        if method_name in _LIST_METHODS:
+            df = pd.DataFrame(json_data[1:], columns = json_data[0])
+            if snapshot is not None:
+                save_catalog_snapshot(df, snapshot)
+            return df
         elif method_name in ['getTimeseriesValues']:
             df = pd.DataFrame(json_data[0]['data'], columns = json_data[0]['columns'].split(','))
             if 'Timestamp' in df.columns:
@@ -154,6 +410,12 @@ def __gen_kiwis_method(cls, method_name, available_query_options, available_retu
     docstring['doc_intro'] += " This optional argument only applies when the returned data includes data with timestamps."
     docstring['doc_intro'] += "\n:type keep_tz: boolean"
 
+    if method_name in _LIST_METHODS:
+        docstring['doc_intro'] += "\n\n:param snapshot: "
+        docstring['doc_intro'] += "Optional directory to also save the returned list to as a memory-mapped catalog snapshot,"
+        docstring['doc_intro'] += " which can be opened by any number of processes with kiwis_pie.snapshot.CatalogSnapshot."
+        docstring['doc_intro'] += "\n:type snapshot: string"
+
     docstring['return_fields'] = ":type return_fields: list(string)\n:param return_fields: Optional keyword argument, which is a list made up from the following available fields:\n\n * {0}.".format(',\n * '.join(available_return_fields))
 
     doc_map = {
@@ -0,0 +1,269 @@
+import contextlib
+import json
+import os
+import shutil
+import uuid
+from collections.abc import Iterable
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+LOCK = 'snapshot.lock'
+VERSIONS = 'versions'
+STAGING = 'staging'
+MATCH_BLOCK_BYTES = 1 << 24
+
+def save_catalog_snapshot(df, path):
+    """
+        Save a catalog DataFrame (e.g. from get_timeseries_list or
+        get_station_list) as a directory of memory-mappable column files.
+
+        Text columns are stored as UTF-8 bytes plus an int64 offsets array
+        (as in Arrow's string layout) and numeric columns keep their dtype.
+        Missing values in text columns are recorded in a separate mask so
+        they are restored on load.
+
+        Each save is written to its own staging directory, then published
+        under an exclusive lock by moving it into ``versions/`` and
+        atomically replacing the manifest, so readers always see either the
+        old or the new snapshot in full and concurrent saves are safe.
+        Previous versions are removed once superseded. Nothing else in path
+        is touched.
+
+        :param df: The catalog to save.
+        :type df: pandas.DataFrame
+        :param path: Directory to write the snapshot to. Created if it
+            doesn't exist; an existing snapshot is replaced.
+        :type path: string
+    """
+    version = uuid.uuid4().hex
+    staging = os.path.join(path, STAGING, version)
+    os.makedirs(staging)
+    os.makedirs(os.path.join(path, VERSIONS), exist_ok = True)
+
+    manifest = {'version': version, 'rows': len(df), 'columns': []}
+    for i, name in enumerate(df.columns):
+        column = df.iloc[:, i]
+        entry = {'name': name, 'values': '{0}.npy'.format(i), 'offsets': None, 'nulls': None}
+
+        if column.dtype.kind in 'biuf':
+            values = column.to_numpy()
+        else:
+            nulls = column.isnull().to_numpy()
+            encoded = [b'' if null else str(value).encode('UTF-8') for value, null in zip(column, nulls)]
+            offsets = np.zeros(len(encoded) + 1, dtype = 'i8')
+            np.cumsum(np.fromiter(map(len, encoded), dtype = 'i8', count = len(encoded)), out = offsets[1:])
+            values = np.frombuffer(b''.join(encoded), dtype = 'u1')
+
+            entry['offsets'] = '{0}.offsets.npy'.format(i)
+            np.save(os.path.join(staging, entry['offsets']), offsets)
+            if nulls.any():
+                entry['nulls'] = '{0}.nulls.npy'.format(i)
+                np.save(os.path.join(staging, entry['nulls']), nulls)
+
+        np.save(os.path.join(staging, entry['values']), values)
+        manifest['columns'].append(entry)
+
+    with open(os.path.join(staging, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+    with _snapshot_lock(path, exclusive = True):
+        os.rename(staging, os.path.join(path, VERSIONS, version))
+        os.replace(os.path.join(path, VERSIONS, version, MANIFEST), os.path.join(path, MANIFEST))
+
+        # Publishing is serialised by the lock, so every other published
+        # version is now superseded. Processes that already mapped one keep
+        # their pages after the files are removed; failures (e.g. files
+        # still open on Windows) are left for the next save to clean up.
+        for old in os.listdir(os.path.join(path, VERSIONS)):
+            if old != version:
+                shutil.rmtree(os.path.join(path, VERSIONS, old), ignore_errors = True)
+
+    logger.debug('Saved catalog snapshot of %d rows to %s (version %s)', len(df), path, version)
+
+@contextlib.contextmanager
+def _snapshot_lock(path, exclusive):
+    """
+        Hold the snapshot's lock file: exclusively while publishing, shared
+        while a reader opens the current version. On Windows, where only
+        exclusive locks are available, both are exclusive.
+    """
+    with open(os.path.join(path, LOCK), 'a+b' if exclusive else 'rb') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class CatalogSnapshot(object):
+    """
+        Read-only, memory-mapped view of a catalog saved with
+        save_catalog_snapshot.
+
+        Opening a snapshot only maps the column files, so it is near
+        instant and the pages are shared by every process on the host that
+        opens the same snapshot. Rows can be selected without decoding any
+        text, and text is only decoded for the rows that are asked for, e.g.
+        ``snapshot.to_dataframe(rows = snapshot.match('station_no', '410730'))``.
+
+        :param path: Directory the snapshot was saved to.
+        :type path: string
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # A shared lock keeps the version named by the manifest from being
+        # removed by a concurrent save until its files are mapped.
+        with _snapshot_lock(path, exclusive = False):
+            self.__open()
+
+    def __open(self):
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            manifest = json.load(f)
+
+        def load(filename):
+            return np.load(os.path.join(self.path, VERSIONS, manifest['version'], filename), mmap_mode = 'r')
+
+        self.version = manifest['version']
+        self.columns = [column['name'] for column in manifest['columns']]
+        self.__rows = manifest['rows']
+        self.__values = {}
+        self.__offsets = {}
+        self.__nulls = {}
+        for column in manifest['columns']:
+            self.__values[column['name']] = load(column['values'])
+            if column['offsets'] is not None:
+                self.__offsets[column['name']] = load(column['offsets'])
+            if column['nulls'] is not None:
+                self.__nulls[column['name']] = load(column['nulls'])
+
+    def __len__(self):
+        return self.__rows
+
+    def __getitem__(self, name):
+        """
+            Return a column as a numpy array. Numeric columns are the
+            read-only memory-mapped array; text columns are decoded into an
+            object array, with missing values as None. Use match to filter
+            on a text column without decoding it.
+        """
+        return self.column(name)
+
+    def column(self, name, rows=None):
+        """
+            Return a column, decoding text only for the selected rows.
+
+            :param name: Column name.
+            :type name: string
+            :param rows: (optional) Boolean mask or integer positions of the
+                rows to include. Default: all.
+            :type rows: numpy.ndarray
+            :rtype: numpy.ndarray
+        """
+        values = self.__values[name]
+        if name not in self.__offsets:
+            return values if rows is None else values[rows]
+
+        positions = np.arange(self.__rows)
+        if rows is not None:
+            positions = positions[rows]
+
+        offsets = self.__offsets[name]
+        decoded = np.empty(len(positions), dtype = object)
+        for i, position in enumerate(positions):
+            decoded[i] = values[offsets[position]:offsets[position + 1]].tobytes().decode('UTF-8')
+
+        if name in self.__nulls:
+            decoded[self.__nulls[name][positions]] = None
+
+        return decoded
+
+    def match(self, name, values):
+        """
+            Return a boolean mask of the rows whose value in a column equals
+            any of values, without decoding the column.
+
+            Text columns are compared directly on their UTF-8 bytes, so
+            filtering stays fast and doesn't copy the column into each
+            process. Missing values never match.
+
+            :param name: Column name.
+            :type name: string
+            :param values: A value or list of values to match.
+            :type values: string | list
+            :rtype: numpy.ndarray
+        """
+        if isinstance(values, (str, bytes)) or not isinstance(values, Iterable):
+            values = [values]
+
+        data = self.__values[name]
+        if name not in self.__offsets:
+            return np.isin(data, list(values))
+
+        offsets = self.__offsets[name]
+        starts = offsets[:-1]
+        lengths = np.diff(offsets)
+        targets = {}
+        for value in set(values):
+            encoded = str(value).encode('UTF-8')
+            targets.setdefault(len(encoded), []).append(encoded)
+
+        mask = np.zeros(self.__rows, dtype = bool)
+        for length, encoded in targets.items():
+            candidates = np.flatnonzero(lengths == length)
+            if length == 0:
+                mask[candidates] = True
+                continue
+
+            # Gather the candidates' bytes as fixed width strings, in blocks
+            # to bound memory, and match them against all targets at once.
+            wanted = np.array(encoded, dtype = 'S{0}'.format(length))
+            block = max(1, MATCH_BLOCK_BYTES // length)
+            for k in range(0, len(candidates), block):
+                rows = candidates[k:k + block]
+                gathered = np.ascontiguousarray(data[starts[rows][:, None] + np.arange(length)])
+                mask[rows[np.isin(gathered.view('S{0}'.format(length)).ravel(), wanted)]] = True
+
+        if name in self.__nulls:
+            mask &= ~self.__nulls[name]
+
+        return mask
+
+    def to_dataframe(self, columns=None, rows=None):
+        """
+            Copy (part of) the snapshot into a pandas DataFrame.
+
+            :param columns: (optional) Columns to include. Default: all.
+            :type columns: list(string)
+            :param rows: (optional) Boolean mask or integer positions of the
+                rows to include. Default: all.
+            :type rows: numpy.ndarray
+            :return: Pandas DataFrame of the selected rows and columns.
+            :rtype: pandas.DataFrame
+        """
+        if columns is None:
+            columns = self.columns
+
+        data = {}
+        for name in columns:
+            values = self.column(name, rows)
+            data[name] = values if values.dtype == object else np.array(values)
+
+        return pd.DataFrame(data, columns = columns)
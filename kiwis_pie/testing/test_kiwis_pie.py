@@ -1,12 +1,21 @@
+import gzip
 import importlib.resources
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
 
+import numpy as np
 import pandas as pd
 import unittest
+import requests
 import requests_mock
 
 from io import StringIO
 
-from kiwis_pie import KIWIS
+from kiwis_pie import CatalogSnapshot, FederatedKIWIS, KIWIS, NoDataError, ResponseArchive, save_catalog_snapshot
 
 class KIWISTest(unittest.TestCase):
 
@@ -30,3 +39,408 @@ class KIWISTest(unittest.TestCase):
         df = self.k.get_parameter_list(station_no = '410730')
         expected.equals(df)
 
+    @requests_mock.mock()
+    def test_compressed_response(self, m):
+        body = json.dumps([['station_no', 'station_name']] + [[str(i), 'Station'] for i in range(1000)]).encode('UTF-8')
+
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getStationList',
+            content = gzip.compress(body),
+            headers = {'Content-Encoding': 'gzip'},
+        )
+
+        df = self.k.get_station_list()
+        self.assertEqual(1000, len(df))
+        self.assertIn('gzip', m.last_request.headers['Accept-Encoding'])
+
+        stats = self.k.last_transfer
+        self.assertEqual('gzip', stats.content_encoding)
+        self.assertEqual(len(gzip.compress(body)), stats.compressed_bytes)
+        self.assertEqual(len(body), stats.decompressed_bytes)
+
+    @requests_mock.mock()
+    def test_corrupt_compressed_response(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getStationList',
+            content = b'not gzip at all',
+            headers = {'Content-Encoding': 'gzip'},
+        )
+
+        self.assertRaises(requests.exceptions.ContentDecodingError, self.k.get_station_list)
+
+
+class FederatedKIWISTest(unittest.TestCase):
+
+    def setUp(self):
+        self.k = FederatedKIWIS({
+            'a': 'http://a.example.com/KiWIS',
+            'b': 'http://b.example.com/KiWIS',
+        })
+
+    @requests_mock.mock()
+    def test_get_station_list(self, m):
+        m.get(
+            'http://a.example.com/KiWIS?request=getStationList',
+            json = [['station_no', 'station_name'], ['1', 'Alpha']]
+        )
+        m.get(
+            'http://b.example.com/KiWIS?request=getStationList',
+            json = [['station_no', 'station_name'], ['2', 'Beta'], ['3', 'Gamma']]
+        )
+
+        df = self.k.get_station_list()
+        self.assertEqual(['source', 'station_no', 'station_name'], list(df.columns))
+        self.assertEqual(['a', 'b', 'b'], list(df.source))
+        self.assertEqual(['1', '2', '3'], list(df.station_no))
+
+    @requests_mock.mock()
+    def test_get_station_list_no_matches(self, m):
+        m.get('http://a.example.com/KiWIS?request=getStationList', json = ['No matches.'])
+        m.get(
+            'http://b.example.com/KiWIS?request=getStationList',
+            json = [['station_no', 'station_name'], ['2', 'Beta']]
+        )
+
+        df = self.k.get_station_list()
+        self.assertEqual(['b'], list(df.source))
+
+        m.get('http://b.example.com/KiWIS?request=getStationList', json = ['No matches.'])
+        self.assertRaises(NoDataError, self.k.get_station_list)
+
+    @requests_mock.mock()
+    def test_get_timeseries_values(self, m):
+        m.get(
+            'http://a.example.com/KiWIS?request=getTimeseriesValues&ts_id=10',
+            json = [{'ts_id': '10', 'columns': 'Timestamp,Value', 'data': [['2016-01-01T00:00:00.000+10:00', 1.0]]}]
+        )
+        m.get(
+            'http://b.example.com/KiWIS?request=getTimeseriesValues&ts_id=10',
+            json = [{'ts_id': '10', 'columns': 'Timestamp,Value', 'data': [['2016-01-01T00:00:00.000+10:00', 2.0]]}]
+        )
+
+        values = self.k.get_timeseries_values([('a', '10'), ('b', '10')])
+        self.assertEqual([1.0], list(values[('a', '10')].Value))
+        self.assertEqual([2.0], list(values[('b', '10')].Value))
+
+        self.assertRaises(ValueError, self.k.get_timeseries_values, [('c', '10')])
+
+    @requests_mock.mock()
+    def test_get_timeseries_values_no_matches(self, m):
+        m.get('http://a.example.com/KiWIS?request=getTimeseriesValues&ts_id=1', json = ['No matches.'])
+        m.get(
+            'http://b.example.com/KiWIS?request=getTimeseriesValues&ts_id=2',
+            json = [{'ts_id': '2', 'columns': 'Timestamp,Value', 'data': [['2016-01-01T00:00:00.000+10:00', 2.0]]}]
+        )
+
+        values = self.k.get_timeseries_values([('a', '1'), ('b', '2')])
+        self.assertEqual([('b', '2')], list(values.keys()))
+
+        self.assertRaises(NoDataError, self.k.get_timeseries_values, [('a', '1')])
+
+    @requests_mock.mock()
+    def test_source_column_clash(self, m):
+        m.get(
+            'http://a.example.com/KiWIS?request=getStationList',
+            json = [['station_no', 'source'], ['1', 'x']]
+        )
+        m.get(
+            'http://b.example.com/KiWIS?request=getStationList',
+            json = [['station_no', 'source'], ['2', 'y']]
+        )
+
+        self.assertRaises(ValueError, self.k.get_station_list)
+
+        k = FederatedKIWIS(self.k.sources, source_column = 'agency')
+        df = k.get_station_list()
+        self.assertEqual(['agency', 'station_no', 'source'], list(df.columns))
+
+    def test_get_timeseries_values_sources_independent(self):
+        # requests_mock serialises requests, so stub the per-source calls instead.
+        a = KIWIS('http://a.example.com/KiWIS')
+        b = KIWIS('http://b.example.com/KiWIS')
+        k = FederatedKIWIS({'a': a, 'b': b}, max_workers_per_source = 1)
+        b_requested = threading.Event()
+
+        def slow_a(ts_id, **kwargs):
+            # Only completes once b has been requested while a is still busy.
+            if not b_requested.wait(5):
+                raise AssertionError('request to b was blocked by requests to a')
+            return ts_id
+
+        def fast_b(ts_id, **kwargs):
+            b_requested.set()
+            return ts_id
+
+        a.get_timeseries_values = slow_a
+        b.get_timeseries_values = fast_b
+
+        values = k.get_timeseries_values([('a', str(i)) for i in range(5)] + [('b', '20')])
+        self.assertEqual(6, len(values))
+        self.assertEqual('20', values[('b', '20')])
+
+class TimeseriesMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.k = KIWIS('http://www.bom.gov.au/waterdata/services')
+        self.response = [
+            {
+                'ts_id': '1',
+                'columns': 'Timestamp,Value,Quality Code',
+                'data': [
+                    ['2016-01-01T00:00:00.000+10:00', 1.0, 10],
+                    ['2016-01-01T06:00:00.000+10:00', 3.0, 10],
+                    ['2016-01-02T00:00:00.000+10:00', 5.0, 140],
+                ],
+            },
+            {
+                'ts_id': '2',
+                'columns': 'Timestamp,Value,Quality Code',
+                'data': [
+                    ['2016-01-01T06:00:00.000+10:00', 2.0, 10],
+                    ['2016-01-03T00:00:00.000+10:00', 4.0, 10],
+                ],
+            },
+        ]
+
+    @requests_mock.mock()
+    def test_union_index(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&ts_id=1,2,3',
+            json = self.response
+        )
+
+        df = self.k.get_timeseries_matrix(['1', '2', '3'])
+        self.assertEqual(['1', '2', '3'], list(df.columns))
+        self.assertEqual(
+            list(pd.to_datetime([
+                '2015-12-31T14:00', '2015-12-31T20:00', '2016-01-01T14:00', '2016-01-02T14:00',
+            ], utc = True)),
+            list(df.index)
+        )
+        self.assertEqual([1.0, 3.0, 5.0], list(df['1'].dropna()))
+        self.assertEqual([2.0, 4.0], list(df['2'].dropna()))
+        self.assertTrue(df['3'].isnull().all())
+
+    @requests_mock.mock()
+    def test_resample_and_quality_mask(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&returnfields=Timestamp,Value,Quality Code',
+            json = self.response
+        )
+
+        df = self.k.get_timeseries_matrix(['1', '2'], freq = 'D', quality_codes = [10])
+        self.assertEqual(
+            list(pd.date_range('2015-12-31', '2016-01-02', freq = 'D', tz = 'UTC')),
+            list(df.index)
+        )
+        self.assertEqual([2.0], list(df['1'].dropna()))
+        self.assertEqual([2.0, 4.0], list(df['2'].dropna()))
+
+    @requests_mock.mock()
+    def test_chunking(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&ts_id=1',
+            json = self.response[:1]
+        )
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&ts_id=2',
+            json = ['No matches.']
+        )
+
+        df = self.k.get_timeseries_matrix(['1', '2'], chunk_size = 1)
+        self.assertEqual(3, df['1'].count())
+        self.assertEqual(0, df['2'].count())
+
+    @requests_mock.mock()
+    def test_decode_processes(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&ts_id=1',
+            json = self.response[:1]
+        )
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&ts_id=2',
+            json = self.response[1:]
+        )
+
+        expected = self.k.get_timeseries_matrix(['1', '2'], chunk_size = 1)
+        df = self.k.get_timeseries_matrix(['1', '2'], chunk_size = 1, max_workers = 2, decode_processes = 2)
+        pd.testing.assert_frame_equal(expected, df)
+
+    @requests_mock.mock()
+    def test_transfer_stats_per_request(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&ts_id=1',
+            json = self.response[:1]
+        )
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getTimeseriesValues&ts_id=2',
+            json = self.response[1:]
+        )
+
+        transfers = []
+        k = KIWIS('http://www.bom.gov.au/waterdata/services', on_transfer = transfers.append)
+        k.get_timeseries_matrix(['1', '2'], chunk_size = 1, max_workers = 2)
+
+        self.assertEqual(2, len(transfers))
+        self.assertEqual(
+            ['ts_id=1', 'ts_id=2'],
+            sorted(param for stats in transfers for param in stats.url.split('&') if param.startswith('ts_id='))
+        )
+
+class ResponseArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'responses.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @requests_mock.mock()
+    def test_record_replay(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getStationList',
+            json = [['station_no', 'station_name'], ['1', 'Alpha']]
+        )
+
+        with ResponseArchive(self.path, mode = 'record') as archive:
+            k = KIWIS('http://www.bom.gov.au/waterdata/services', archive = archive)
+            expected = k.get_station_list(station_no = ['1'])
+            self.assertEqual(1, len(archive))
+
+        m.reset_mock()
+        with ResponseArchive(self.path) as archive:
+            k = KIWIS('http://www.bom.gov.au/waterdata/services', archive = archive)
+            pd.testing.assert_frame_equal(expected, k.get_station_list(station_no = '1'))
+            self.assertEqual('archive', k.last_transfer.content_encoding)
+            self.assertRaises(KeyError, k.get_station_list, station_no = '2')
+
+        self.assertFalse(m.called)
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, ResponseArchive, self.path, mode = 'bogus')
+
+    def test_replay_missing_archive(self):
+        self.assertRaises(sqlite3.OperationalError, ResponseArchive, self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+def _save_snapshots(path, rows):
+    for i in range(20):
+        save_catalog_snapshot(pd.DataFrame({'station_no': [str(j) for j in range(rows)]}), path)
+        CatalogSnapshot(path)
+
+class CatalogSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'stations')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @requests_mock.mock()
+    def test_snapshot(self, m):
+        m.get(
+            'http://www.bom.gov.au/waterdata/services?request=getStationList',
+            json = [['station_no', 'station_name'], ['1', 'Alpha'], ['2', None], ['3', 'Gamma']]
+        )
+
+        k = KIWIS('http://www.bom.gov.au/waterdata/services')
+        expected = k.get_station_list(snapshot = self.path)
+
+        snapshot = CatalogSnapshot(self.path)
+        self.assertEqual(3, len(snapshot))
+        self.assertEqual(['station_no', 'station_name'], snapshot.columns)
+        self.assertEqual(['1', '2', '3'], list(snapshot['station_no']))
+        pd.testing.assert_frame_equal(expected, snapshot.to_dataframe())
+
+        df = snapshot.to_dataframe(columns = ['station_name'], rows = snapshot['station_no'] != '1')
+        self.assertEqual([True, False], list(df.station_name.isnull()))
+        self.assertEqual('Gamma', df.station_name.iloc[1])
+
+    def test_long_and_non_ascii_values(self):
+        long_value = 'x' * 2000
+        df = pd.DataFrame({
+            'station_no': [str(i) for i in range(1000)],
+            'custom_attributes': [long_value] + ['Wagga Wagga – Murrumbidgee 水'] * 999,
+            'station_latitude': np.linspace(-35.0, -34.0, 1000),
+        })
+        save_catalog_snapshot(df, self.path)
+
+        snapshot = CatalogSnapshot(self.path)
+        pd.testing.assert_frame_equal(df, snapshot.to_dataframe())
+        self.assertEqual([long_value], list(snapshot.column('custom_attributes', rows = [0])))
+
+        # Stored as UTF-8 bytes, not padded to the longest value.
+        data_file = os.path.join(self.path, 'versions', snapshot.version, '1.npy')
+        self.assertLess(os.path.getsize(data_file), 2 * 999 * len('Wagga Wagga – Murrumbidgee 水'.encode('UTF-8')))
+
+    def test_replace_snapshot(self):
+        save_catalog_snapshot(pd.DataFrame({'station_no': ['1', '2', '3']}), self.path)
+        old = CatalogSnapshot(self.path)
+
+        save_catalog_snapshot(pd.DataFrame({'station_no': ['4']}), self.path)
+        new = CatalogSnapshot(self.path)
+
+        self.assertNotEqual(old.version, new.version)
+        self.assertEqual(['4'], list(new['station_no']))
+        self.assertEqual([new.version], os.listdir(os.path.join(self.path, 'versions')))
+        # Already opened snapshots keep their mapped pages.
+        self.assertEqual(['1', '2', '3'], list(old['station_no']))
+
+    def test_unrelated_directories_kept(self):
+        os.makedirs(os.path.join(self.path, 'important'))
+        save_catalog_snapshot(pd.DataFrame({'station_no': ['1']}), self.path)
+        save_catalog_snapshot(pd.DataFrame({'station_no': ['2']}), self.path)
+        self.assertTrue(os.path.isdir(os.path.join(self.path, 'important')))
+
+    def test_concurrent_saves(self):
+        ctx = multiprocessing.get_context('spawn')
+        processes = [ctx.Process(target = _save_snapshots, args = (self.path, n)) for n in range(1, 5)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual([0] * 4, [p.exitcode for p in processes])
+
+        snapshot = CatalogSnapshot(self.path)
+        self.assertIn(len(snapshot), range(1, 5))
+        self.assertEqual([str(i) for i in range(len(snapshot))], list(snapshot['station_no']))
+        self.assertEqual([snapshot.version], os.listdir(os.path.join(self.path, 'versions')))
+
+    def test_match(self):
+        df = pd.DataFrame({
+            'station_no': ['410730', '410731', None, '', 'Kārāwa', '41073'],
+            'station_id': [1, 2, 3, 4, 5, 6],
+        })
+        save_catalog_snapshot(df, self.path)
+        snapshot = CatalogSnapshot(self.path)
+
+        self.assertEqual([True, False, False, False, False, False], list(snapshot.match('station_no', '410730')))
+        self.assertEqual(
+            [False, True, False, True, True, False],
+            list(snapshot.match('station_no', ['410731', '', 'Kārāwa']))
+        )
+        self.assertEqual([False, True, True, False, False, False], list(snapshot.match('station_id', [2, 3])))
+
+    @requests_mock.mock()
+    def test_federated_snapshot(self, m):
+        m.get(
+            'http://a.example.com/KiWIS?request=getStationList',
+            json = [['station_no', 'station_name'], ['1', 'Alpha']]
+        )
+        m.get(
+            'http://b.example.com/KiWIS?request=getStationList',
+            json = [['station_no', 'station_name'], ['2', 'Beta'], ['3', 'Gamma']]
+        )
+
+        k = FederatedKIWIS({'a': 'http://a.example.com/KiWIS', 'b': 'http://b.example.com/KiWIS'})
+        expected = k.get_station_list(snapshot = self.path)
+        self.assertEqual(3, len(expected))
+        pd.testing.assert_frame_equal(expected, CatalogSnapshot(self.path).to_dataframe())
+
+    @requests_mock.mock()
+    def test_snapshot_not_list_method(self, m):
+        k = KIWIS('http://www.bom.gov.au/waterdata/services')
+        self.assertRaises(ValueError, k.get_timeseries_values, ts_id = '1', snapshot = self.path)
+        self.assertFalse(m.called)